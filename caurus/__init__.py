@@ -4,6 +4,7 @@ from cryptography.hazmat.primitives.hmac import HMAC
 from cryptography.hazmat.primitives import ciphers
 
 _VERSION = 3
+_ACCOUNT_BITS = 25
 
 STYLE_BOLD = 'S'
 STYLE_BLACK = 'K'
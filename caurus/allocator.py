@@ -0,0 +1,133 @@
+import contextlib
+import fcntl
+import mmap
+import os
+import tempfile
+import threading
+import caurus
+
+
+_SIZE = (1 << caurus._ACCOUNT_BITS) // 8
+_ATTEMPTS = 64
+_CHUNK = 1 << 16
+
+
+def _check_account(account):
+    if not (0 <= account < (1 << caurus._ACCOUNT_BITS)):
+        raise ValueError('Invalid account number')
+
+
+def _build(accounts):
+    bitmap = bytearray(_SIZE)
+    for account in accounts:
+        _check_account(account)
+        bitmap[account >> 3] |= 1 << (account & 7)
+    return bitmap
+
+
+def _create(path, accounts):
+    # the bitmap is filled in a temporary file and linked into place, so other processes
+    # never observe an empty or partially written bitmap
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_build(accounts))
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+    finally:
+        os.unlink(tmp)
+
+
+class AccountAllocator:
+    # one bit per account number, shared between processes through a memory-mapped file
+    # which is locked exclusively while modifying it
+
+    def __init__(self, path, accounts=()):
+        try:
+            self._fd = os.open(path, os.O_RDWR)
+        except FileNotFoundError:
+            _create(path, accounts)
+            self._fd = os.open(path, os.O_RDWR)
+        self._lock = threading.Lock()
+        try:
+            if os.fstat(self._fd).st_size != _SIZE:
+                raise Exception('Invalid bitmap size')
+            self._bitmap = mmap.mmap(self._fd, _SIZE)
+        except BaseException:
+            os.close(self._fd)
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._fd is not None:
+            self._bitmap.close()
+            os.close(self._fd)
+            self._fd = None
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _test_and_set(self, account):
+        index, mask = account >> 3, 1 << (account & 7)
+        if self._bitmap[index] & mask:
+            return False
+        self._bitmap[index] |= mask
+        return True
+
+    def _scan(self, start):
+        # fallback for a (nearly) full bitmap: find the first byte with a free bit
+        for offset in list(range(start, _SIZE, _CHUNK)) + list(range(0, start, _CHUNK)):
+            chunk = self._bitmap[offset:min(offset + _CHUNK, _SIZE)]
+            free = len(chunk) - len(chunk.lstrip(b'\xff'))
+            if free < len(chunk):
+                byte = chunk[free]
+                bit = next(i for i in range(8) if not byte & (1 << i))
+                return ((offset + free) << 3) | bit
+        return None
+
+    def reserve(self, account):
+        _check_account(account)
+        with self._locked():
+            return self._test_and_set(account)
+
+    def release(self, account):
+        _check_account(account)
+        with self._locked():
+            self._bitmap[account >> 3] &= ~(1 << (account & 7)) & 0xff
+
+    def allocate(self, random):
+        with self._locked():
+            for _ in range(_ATTEMPTS):
+                account = random.getrandbits(caurus._ACCOUNT_BITS)
+                if self._test_and_set(account):
+                    return account
+            account = self._scan(random.randrange(0, _SIZE, _CHUNK))
+            if account is None:
+                raise Exception('No free account numbers')
+            self._test_and_set(account)
+            return account
+
+    def rebuild(self, accounts, reset=False):
+        # without reset, the accounts are added to the existing reservations, as other
+        # processes might hold reservations which are not recorded anywhere else
+        bitmap = _build(accounts)
+        with self._locked():
+            if not reset:
+                bitmap = (int.from_bytes(bitmap, 'big') | int.from_bytes(self._bitmap, 'big')).to_bytes(_SIZE, 'big')
+            self._bitmap[:] = bitmap
+            self._bitmap.flush()
@@ -1,14 +1,18 @@
 import argparse
 import base64
 import configparser
+import glob
+import json
+import multiprocessing
 import os
 import random
 import subprocess
 import sys
 import tempfile
+import zipfile
 from binascii import hexlify, unhexlify
 from bitstring import Bits, BitArray
-from collections import namedtuple
+from collections import deque, namedtuple
 from cryptography.hazmat.backends import default_backend
 import caurus
 import caurus.barcode
@@ -19,6 +23,8 @@ _UninitializedContext = namedtuple('_UninitializedContext', ['random', 'crypto']
 _Context = namedtuple('_Context', ['service_id', 'service_mac', 'service_key', 'accounts', 'random', 'crypto'])
 _Account = namedtuple('_Account', ['id', 'key', 'salt'])
 
+_provision_context = None
+
 
 def serialize_barcode(barcode):
     result = BitArray()
@@ -52,6 +58,22 @@ def view_barcode(barcode, viewer):
         print('Barcode: {}'.format(serialize_barcode(barcode)))
 
 
+def account_range(value):
+    first, _, last = value.partition('-')
+    first = int(first)
+    last = int(last) if last else first
+    if not (0 <= first <= last < (1 << caurus._ACCOUNT_BITS)):
+        raise argparse.ArgumentTypeError('invalid account range: {}'.format(value))
+    return range(first, last + 1)
+
+
+def positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError('must be at least 1: {}'.format(value))
+    return value
+
+
 def input_code(length):
     while True:
         code = input('Code: ')
@@ -85,6 +107,18 @@ def build_context(args):
     )
 
 
+def bitmap_path(args):
+    if args.bitmap:
+        return args.bitmap
+    return os.path.splitext(args.config.name)[0] + '.bitmap'
+
+
+def open_allocator(args, context):
+    # imported on demand, the allocator relies on fcntl which is not available everywhere
+    import caurus.allocator
+    return caurus.allocator.AccountAllocator(bitmap_path(args), context.accounts.keys())
+
+
 def barcode_svg(args):
     barcode = deserialize_barcode(args.barcode)
     print(caurus.barcode.to_svg(barcode, args.background))
@@ -113,8 +147,28 @@ def server_init(args):
 
 def server_activate(args):
     context = build_context(args)
+    with open_allocator(args, context) as allocator:
+        account = args.account
+        if account is None:
+            account = allocator.allocate(context.random)
+            while account in context.accounts:
+                # stale bitmap, keep the configured account marked and pick another one
+                account = allocator.allocate(context.random)
+        elif account not in context.accounts and not allocator.reserve(account):
+            print('Account is already in use', file=sys.stderr)
+            return 1
+
+        result = 1
+        try:
+            result = activate(args, account, context)
+        finally:
+            if result and account not in context.accounts:
+                allocator.release(account)
+        return result
+
 
-    account, account_id, account_key, code, barcode = caurus.server.start_activation(context, args.account)
+def activate(args, account, context):
+    account, account_id, account_key, code, barcode = caurus.server.start_activation(context, account)
     view_barcode(barcode, args.viewer)
     if input_code(7) != code:
         print('Invalid code', file=sys.stderr)
@@ -143,6 +197,191 @@ def server_activate(args):
     config.write(sys.stdout)
 
 
+def server_rebuild(args):
+    context = build_context(args)
+    accounts = set(context.accounts)
+    for directory in provisioned_directories(args) + (args.provisioned or []):
+        accounts.update(provisioned_accounts(directory))
+    with open_allocator(args, context) as allocator:
+        allocator.rebuild(accounts, args.reset)
+    print('Rebuilt bitmap with {} accounts'.format(len(accounts)))
+
+
+def _init_provision(service_id, service_mac, service_key):
+    global _provision_context
+    _provision_context = _Context(
+        service_id=service_id,
+        service_mac=service_mac,
+        service_key=service_key,
+        accounts={},
+        random=random.SystemRandom(),
+        crypto=default_backend(),
+    )
+
+
+def _provision_chunk(job):
+    path, accounts = job
+    context = _provision_context
+    manifest = []
+    try:
+        os.remove(path + '.tmp')
+    except FileNotFoundError:
+        pass
+    # the archive contains activation keys, so keep it private
+    fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with open(fd, 'wb') as f, zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for account in accounts:
+            account, account_id, account_key, code, barcode = caurus.server.start_activation(context, account)
+            archive.writestr('{}.svg'.format(account), caurus.barcode.to_svg(barcode, background=True))
+            manifest.append(json.dumps({
+                'account': account,
+                'id': hexlify(account_id).decode(),
+                'key': hexlify(account_key).decode(),
+                'code': code,
+                'barcode': serialize_barcode(barcode),
+            }))
+        archive.writestr('manifest.jsonl', '\n'.join(manifest) + '\n')
+    os.replace(path + '.tmp', path + '.zip')
+    return path + '.zip', len(accounts)
+
+
+def provision_chunks(args):
+    # duplicates are tracked in a bitmap, so memory stays bounded even for huge ranges
+    seen = bytearray(1 << caurus._ACCOUNT_BITS >> 3)
+    chunk = []
+    index = 0
+    for accounts in args.accounts:
+        for account in accounts:
+            if seen[account >> 3] & (1 << (account & 7)):
+                continue
+            seen[account >> 3] |= 1 << (account & 7)
+            chunk.append(account)
+            if len(chunk) == args.chunk_size:
+                yield os.path.join(args.output, 'chunk-{:05d}'.format(index)), chunk
+                chunk = []
+                index += 1
+    if chunk:
+        yield os.path.join(args.output, 'chunk-{:05d}'.format(index)), chunk
+
+
+def read_reserved(path):
+    with open(path) as f:
+        return [int(line) for line in f if line.strip()]
+
+
+def write_reserved(path, accounts):
+    with open(path + '.tmp', 'w') as f:
+        f.write(''.join('{}\n'.format(account) for account in accounts))
+    os.replace(path + '.tmp', path)
+
+
+def provisioned_accounts(directory):
+    for path in sorted(glob.glob(os.path.join(directory, 'chunk-*.accounts'))):
+        for account in read_reserved(path):
+            yield account
+
+
+def provisioned_path(args):
+    return os.path.splitext(bitmap_path(args))[0] + '.provisioned'
+
+
+def provisioned_directories(args):
+    try:
+        with open(provisioned_path(args)) as f:
+            return list(dict.fromkeys(line.strip() for line in f if line.strip()))
+    except FileNotFoundError:
+        return []
+
+
+def register_provisioned(args):
+    # output directories are remembered next to the bitmap, so rebuilding it never
+    # drops the reservations of provisioned accounts
+    directory = os.path.abspath(args.output)
+    if directory not in provisioned_directories(args):
+        with open(provisioned_path(args), 'a') as f:
+            f.write(directory + '\n')
+
+
+def _reserve_chunk(path, chunk, context, allocator):
+    # returns whether the chunk was reserved by this call and an error message
+    if os.path.exists(path + '.accounts'):
+        if read_reserved(path + '.accounts') != chunk:
+            return False, 'Accounts of {} differ from the previous run'.format(path)
+        if os.path.exists(path + '.zip'):
+            return False, None
+    elif os.path.exists(path + '.zip'):
+        return False, 'Accounts of {} differ from the previous run'.format(path)
+
+    activated = [account for account in chunk if account in context.accounts]
+    if activated:
+        return False, 'Account {} is already activated'.format(activated[0])
+
+    if os.path.exists(path + '.accounts'):
+        # an interrupted run recorded these accounts after reserving them, and the reservations
+        # of registered output directories survive rebuilds, so a taken account is still held
+        # by this chunk
+        for account in chunk:
+            allocator.reserve(account)
+        return False, None
+
+    reserved = []
+    for account in chunk:
+        if not allocator.reserve(account):
+            for other in reserved:
+                allocator.release(other)
+            return False, 'Account {} is already in use'.format(account)
+        reserved.append(account)
+    write_reserved(path + '.accounts', chunk)
+    return True, None
+
+
+def _reserve_chunks(args, context, allocator):
+    created = bytearray(1 << caurus._ACCOUNT_BITS >> 3)
+    for index, (path, chunk) in enumerate(provision_chunks(args)):
+        reserved, error = _reserve_chunk(path, chunk, context, allocator)
+        if reserved:
+            created[index >> 3] |= 1 << (index & 7)
+        if error:
+            # roll back the chunks reserved by this run, so a corrected run can start over
+            for other, (other_path, other_chunk) in enumerate(provision_chunks(args)):
+                if other == index:
+                    break
+                if created[other >> 3] & (1 << (other & 7)):
+                    os.remove(other_path + '.accounts')
+                    for account in other_chunk:
+                        allocator.release(account)
+            return error
+    return None
+
+
+def server_provision(args):
+    context = build_context(args)
+    os.makedirs(args.output, exist_ok=True)
+    register_provisioned(args)
+
+    # reserve the accounts of all pending chunks first, the reservations are recorded
+    # next to the archives so an interrupted run can be resumed
+    with open_allocator(args, context) as allocator:
+        error = _reserve_chunks(args, context, allocator)
+    if error:
+        print(error, file=sys.stderr)
+        return 1
+
+    # submit a limited number of chunks ahead, so memory does not grow with the number of accounts
+    window = 2 * (args.jobs or os.cpu_count() or 1)
+    initargs = (context.service_id, context.service_mac, context.service_key)
+    with multiprocessing.Pool(args.jobs, _init_provision, initargs) as pool:
+        results = deque()
+        for path, chunk in provision_chunks(args):
+            if os.path.exists(path + '.zip'):
+                continue
+            results.append(pool.apply_async(_provision_chunk, ((path, chunk),)))
+            if len(results) >= window:
+                print('{}: {} accounts'.format(*results.popleft().get()))
+        while results:
+            print('{}: {} accounts'.format(*results.popleft().get()))
+
+
 def server_transaction(args):
     context = build_context(args)
     if args.account not in context.accounts:
@@ -185,6 +424,11 @@ def main():
             '--viewer',
             help='path to a SVG viewer')
 
+    def add_bitmap_argument(parser):
+        parser.add_argument(
+            '--bitmap',
+            help='path to the bitmap of used account numbers (default: next to the configuration file)')
+
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers()  # (required=True)
 
@@ -212,8 +456,35 @@ def main():
     parser_server_activate.set_defaults(func=server_activate)
     add_config_argument(parser_server_activate)
     add_viewer_argument(parser_server_activate)
+    add_bitmap_argument(parser_server_activate)
     parser_server_activate.add_argument('account', type=int, nargs='?', help='account number')
 
+    parser_server_provision = subparsers_server.add_parser('provision')
+    parser_server_provision.set_defaults(func=server_provision)
+    add_config_argument(parser_server_provision)
+    add_bitmap_argument(parser_server_provision)
+    parser_server_provision.add_argument(
+        '--output',
+        help='directory for the generated archives',
+        default='provision')
+    parser_server_provision.add_argument('--chunk-size', type=positive_int, help='accounts per archive', default=1000)
+    parser_server_provision.add_argument('--jobs', type=positive_int, help='number of worker processes')
+    parser_server_provision.add_argument(
+        'accounts', type=account_range, nargs='+', help='account numbers or ranges (e.g. 100-199)')
+
+    parser_server_rebuild = subparsers_server.add_parser('rebuild')
+    parser_server_rebuild.set_defaults(func=server_rebuild)
+    add_config_argument(parser_server_rebuild)
+    add_bitmap_argument(parser_server_rebuild)
+    parser_server_rebuild.add_argument(
+        '--provisioned',
+        action='append',
+        help='additional output directory of server provision whose reservations are kept')
+    parser_server_rebuild.add_argument(
+        '--reset',
+        action='store_true',
+        help='drop all reservations which are not part of the configuration or provisioned')
+
     parser_server_transaction = subparsers_server.add_parser('transaction')
     parser_server_transaction.set_defaults(func=server_transaction)
     add_config_argument(parser_server_transaction)
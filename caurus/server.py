@@ -78,7 +78,7 @@ def build_barcode(type, account, payload, encryption_key, mac_key, context):
     message += Bits(uint=caurus._VERSION, length=8)
     message += Bits(uint=type, length=4)
     message += Bits(uint=context.service_id, length=6)
-    message += Bits(uint=account, length=25)
+    message += Bits(uint=account, length=caurus._ACCOUNT_BITS)
     message += Bits(bool=True)
     message += Bits(length=64)
     message += Bits(bytes=encrypted, length=604)
@@ -91,8 +91,8 @@ def build_barcode(type, account, payload, encryption_key, mac_key, context):
 
 def start_activation(context, account=None):
     if account is None:
-        account = context.random.getrandbits(10)
-    elif not (0 <= account < (1 << 10)):
+        account = context.random.getrandbits(caurus._ACCOUNT_BITS)
+    elif not (0 <= account < (1 << caurus._ACCOUNT_BITS)):
         raise ValueError('Invalid account number')
     id = caurus._random_bytes(16, context)
     key = caurus._random_bytes(16, context)
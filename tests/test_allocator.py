@@ -0,0 +1,103 @@
+import multiprocessing
+import os
+import random
+import tempfile
+import unittest
+import caurus
+import caurus.allocator
+from caurus.allocator import AccountAllocator
+
+
+def _allocate(path, count):
+    with AccountAllocator(path) as allocator:
+        return [allocator.allocate(random.SystemRandom()) for _ in range(count)]
+
+
+class AccountAllocatorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'caurus.bitmap')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def fill(self, allocator, free):
+        # mark every account number except the given ones as used
+        bitmap = bytearray(b'\xff' * caurus.allocator._SIZE)
+        for account in free:
+            bitmap[account >> 3] &= ~(1 << (account & 7)) & 0xff
+        allocator._bitmap[:] = bitmap
+
+    def test_create(self):
+        with AccountAllocator(self.path, [1, 2]) as allocator:
+            self.assertFalse(allocator.reserve(1))
+            self.assertFalse(allocator.reserve(2))
+            self.assertTrue(allocator.reserve(3))
+        self.assertEqual(os.stat(self.path).st_size, 1 << caurus._ACCOUNT_BITS >> 3)
+        self.assertEqual(os.listdir(self.directory.name), ['caurus.bitmap'])
+
+        # accounts are only used when creating the bitmap
+        with AccountAllocator(self.path, [4]) as allocator:
+            self.assertFalse(allocator.reserve(3))
+            self.assertTrue(allocator.reserve(4))
+
+    def test_reserve_release(self):
+        with AccountAllocator(self.path) as allocator:
+            self.assertTrue(allocator.reserve(42))
+            self.assertFalse(allocator.reserve(42))
+            allocator.release(42)
+            self.assertTrue(allocator.reserve(42))
+            self.assertRaises(ValueError, allocator.reserve, 1 << caurus._ACCOUNT_BITS)
+            self.assertRaises(ValueError, allocator.release, -1)
+
+    def test_shared(self):
+        with AccountAllocator(self.path) as first, AccountAllocator(self.path) as second:
+            self.assertTrue(first.reserve(7))
+            self.assertFalse(second.reserve(7))
+            second.release(7)
+            self.assertTrue(first.reserve(7))
+
+    def test_rebuild(self):
+        with AccountAllocator(self.path, [1]) as allocator:
+            allocator.reserve(2)
+            allocator.rebuild([3, 4])
+            for account in [1, 2, 3, 4]:
+                self.assertFalse(allocator.reserve(account))
+
+    def test_rebuild_reset(self):
+        with AccountAllocator(self.path, [1]) as allocator:
+            allocator.reserve(2)
+            allocator.rebuild([3, 4], reset=True)
+            self.assertTrue(allocator.reserve(1))
+            self.assertTrue(allocator.reserve(2))
+            self.assertFalse(allocator.reserve(3))
+            self.assertFalse(allocator.reserve(4))
+
+    def test_allocate(self):
+        with AccountAllocator(self.path) as allocator:
+            accounts = {allocator.allocate(random.SystemRandom()) for _ in range(100)}
+            self.assertEqual(len(accounts), 100)
+            for account in accounts:
+                self.assertFalse(allocator.reserve(account))
+
+    def test_allocate_full(self):
+        free = [0, 8 * 70000 + 3, (1 << caurus._ACCOUNT_BITS) - 1]
+        with AccountAllocator(self.path) as allocator:
+            self.fill(allocator, free)
+            accounts = {allocator.allocate(random.SystemRandom()) for _ in free}
+            self.assertEqual(accounts, set(free))
+            self.assertRaises(Exception, allocator.allocate, random.SystemRandom())
+
+    def test_allocate_processes(self):
+        free = set(random.sample(range(1 << caurus._ACCOUNT_BITS), 40))
+        with AccountAllocator(self.path) as allocator:
+            self.fill(allocator, free)
+        with multiprocessing.Pool(4) as pool:
+            results = pool.starmap(_allocate, [(self.path, 10)] * 4)
+        accounts = [account for result in results for account in result]
+        self.assertEqual(len(accounts), len(free))
+        self.assertEqual(set(accounts), free)
+
+
+if __name__ == '__main__':
+    unittest.main()
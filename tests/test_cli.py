@@ -0,0 +1,126 @@
+import contextlib
+import io
+import json
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+import caurus.cli
+from caurus.allocator import AccountAllocator
+
+
+class ProvisionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.config = self.path('caurus.cfg')
+        self.bitmap = self.path('caurus.bitmap')
+        self.output = self.path('provision')
+        self.run_cli('server', 'init', '--config', self.config)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def run_cli(self, *args):
+        with mock.patch('sys.argv', ['caurus'] + list(args)), \
+                contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            return caurus.cli.main()
+
+    def provision(self, *accounts):
+        return self.run_cli('server', 'provision', '--config', self.config, '--bitmap', self.bitmap,
+                            '--output', self.output, '--chunk-size', '3', '--jobs', '1', *accounts)
+
+    def activate(self, account):
+        with open(self.config, 'a') as f:
+            f.write('[account.{}]\nid = 00\nkey = 00\nsalt = 00\n'.format(account))
+
+    def test_provision(self):
+        self.assertFalse(self.provision('1-4', '3', '10'))
+        self.assertEqual(sorted(os.listdir(self.output)), [
+            'chunk-00000.accounts', 'chunk-00000.zip', 'chunk-00001.accounts', 'chunk-00001.zip'])
+
+        path = os.path.join(self.output, 'chunk-00001.zip')
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+        with zipfile.ZipFile(path) as archive:
+            self.assertEqual(sorted(archive.namelist()), ['10.svg', '4.svg', 'manifest.jsonl'])
+            manifest = [json.loads(line) for line in archive.read('manifest.jsonl').decode().splitlines()]
+        self.assertEqual([entry['account'] for entry in manifest], [4, 10])
+        self.assertEqual(len(manifest[0]['code']), 7)
+
+        with AccountAllocator(self.bitmap) as allocator:
+            for account in [1, 2, 3, 4, 10]:
+                self.assertFalse(allocator.reserve(account))
+
+    def test_resume(self):
+        self.assertFalse(self.provision('1-7', '10'))
+        os.remove(os.path.join(self.output, 'chunk-00002.zip'))
+        self.activate(2)
+
+        self.assertFalse(self.provision('1-7', '10'))
+        self.assertTrue(os.path.exists(os.path.join(self.output, 'chunk-00002.zip')))
+
+        self.activate(7)
+        os.remove(os.path.join(self.output, 'chunk-00002.zip'))
+        self.assertEqual(self.provision('1-7', '10'), 1)
+
+    def test_changed_arguments(self):
+        self.assertFalse(self.provision('1-4'))
+        self.assertEqual(self.provision('100-103'), 1)
+        self.assertEqual(self.provision('--chunk-size', '2', '1-4'), 1)
+        with AccountAllocator(self.bitmap) as allocator:
+            self.assertTrue(allocator.reserve(100))
+
+    def test_reserved(self):
+        with AccountAllocator(self.bitmap) as allocator:
+            allocator.reserve(5)
+        self.assertEqual(self.provision('1-6'), 1)
+        self.assertEqual(os.listdir(self.output), [])
+        with AccountAllocator(self.bitmap) as allocator:
+            self.assertTrue(allocator.reserve(1))
+            self.assertTrue(allocator.reserve(4))
+
+    def test_worker_error(self):
+        # a directory in place of the temporary archive makes the worker fail
+        self.assertFalse(self.provision('1-3'))
+        os.mkdir(os.path.join(self.output, 'chunk-00001.tmp'))
+        self.assertRaises(OSError, self.provision, '1-9')
+        self.assertFalse(os.path.exists(os.path.join(self.output, 'chunk-00001.zip')))
+
+        os.rmdir(os.path.join(self.output, 'chunk-00001.tmp'))
+        self.assertFalse(self.provision('1-9'))
+        self.assertTrue(os.path.exists(os.path.join(self.output, 'chunk-00001.zip')))
+        self.assertTrue(os.path.exists(os.path.join(self.output, 'chunk-00002.zip')))
+
+    def test_rebuild(self):
+        self.assertFalse(self.provision('1-4'))
+        with AccountAllocator(self.bitmap) as allocator:
+            allocator.reserve(5)
+        self.run_cli('server', 'rebuild', '--config', self.config, '--bitmap', self.bitmap, '--reset')
+        with AccountAllocator(self.bitmap) as allocator:
+            for account in [1, 2, 3, 4]:
+                self.assertFalse(allocator.reserve(account))
+            self.assertTrue(allocator.reserve(5))
+
+    def test_default_bitmap(self):
+        self.assertFalse(self.run_cli('server', 'rebuild', '--config', self.config))
+        self.assertTrue(os.path.exists(self.path('caurus.bitmap')))
+
+    def test_lazy_allocator(self):
+        # client-side commands must not depend on the POSIX-only allocator
+        code = 'import sys, caurus.cli; sys.exit("caurus.allocator" in sys.modules)'
+        self.assertEqual(subprocess.call([sys.executable, '-c', code]), 0)
+
+    def test_invalid_arguments(self):
+        self.assertRaises(SystemExit, self.provision, '--chunk-size', '0', '1')
+        self.assertRaises(SystemExit, self.provision, '--jobs', '0', '1')
+        self.assertRaises(SystemExit, self.provision, '5-1')
+
+
+if __name__ == '__main__':
+    unittest.main()